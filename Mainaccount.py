@@ -12,6 +12,7 @@ from Portfoliomanager1 import MDP
 from Portfoliomanager1 import RWP
 from Portfoliomanager1 import EWP
 from Portfoliomanager1 import calculate_portfolio_statistics
+from Portfoliomanager1 import build_context
 from matplotlib.figure import Figure
 
 # First balance available to the user
@@ -167,7 +168,7 @@ def display_user_info(parent_window):
     canvas.draw()
 
     # Calculate and display portfolio statistics
-    portfolio_return, portfolio_risk, sharpe_ratio, beta = calculate_portfolio_statistics(transactions)
+    portfolio_return, portfolio_risk, sharpe_ratio, beta = calculate_portfolio_statistics(build_context(transactions))
 
     # Create a frame for key statistics
     stats_frame = tk.Frame(user_info_window)
@@ -202,7 +203,8 @@ def show_new_weights_and_investments(parent_window, portfolio_function):
 
     # Calculate new portfolio weights, investments and new key statistics
     global transactions
-    new_weights, investments, portfolio_return, portfolio_risk, sharpe_ratio, beta = portfolio_function(transactions)
+    context = build_context(transactions)
+    new_weights, investments, portfolio_return, portfolio_risk, sharpe_ratio, beta = portfolio_function(context)
 
     # Create a new window to display the results
     results_window = tk.Toplevel(parent_window)
@@ -217,9 +219,7 @@ def show_new_weights_and_investments(parent_window, portfolio_function):
     # Display new portfolio weights
     weights_label = tk.Label(results_window, text="New Portfolio Weights:", font=("Calibri", 14, "bold"))
     weights_label.grid(row=1, column=0, sticky='w', padx=10, pady=10)
-    unique_stocks = list({transaction[0] for transaction in transactions})
-
-    for idx, (stock, weight) in enumerate(zip(unique_stocks, new_weights)):
+    for idx, (stock, weight) in enumerate(zip(context.selected_stocks, new_weights)):
         weight_label = tk.Label(results_window, text=f"{stock}: {weight * 100:.2f}%", font=("Calibri", 12))
         weight_label.grid(row=idx + 2, column=0, sticky='w', padx=10)
 
@@ -1,200 +1,297 @@
+import os
+import time
+import hashlib
+from dataclasses import dataclass, field
 import pandas as pd
 import numpy as np
 import yfinance as yf
 from scipy.optimize import minimize
 
-# Function that downloads the stock data
-def load_stock_data(transactions, start_date, end_date):
-    stock_symbols = list(set([transaction[0] for transaction in transactions]))
-    stock_data = yf.download(stock_symbols, start=start_date, end=end_date)
+# Numba is optional, without it the jitted functions run as plain NumPy
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+# PyArrow is optional, without it the prices are only cached in memory
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+# Folder where the downloaded prices are kept between runs, next to this file whatever the working directory
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+# Time (in seconds) after which the 1 day prices are downloaded again, historical prices never expire
+INTRADAY_TTL = 24 * 60 * 60
+# Prices already downloaded in this run, with the time they were downloaded
+_price_cache = {}
+
+# Function that returns the file of the disk cache for a download
+def _cache_path(symbols, start_date, end_date, period):
+    key = "|".join(sorted(symbols)) + f"|{start_date}|{end_date}|{period}"
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.feather')
+
+# Function that downloads the adjusted closing prices once (one column per symbol) and keeps them in memory and on disk
+def _download_prices(symbols, start_date=None, end_date=None, period=None):
+    key = (symbols, start_date, end_date, period)
+    ttl = INTRADAY_TTL if period is not None else None
+    if key in _price_cache:
+        downloaded_at, data = _price_cache[key]
+        if ttl is None or time.time() - downloaded_at < ttl:
+            return data
+
+    path = _cache_path(symbols, start_date, end_date, period)
+    if feather is not None and os.path.exists(path) and (ttl is None or time.time() - os.path.getmtime(path) < ttl):
+        data = feather.read_table(path, memory_map=True).to_pandas().set_index('Date')
+        _price_cache[key] = (os.path.getmtime(path), data)
+        return data
+
+    tickers = list(symbols) if len(symbols) > 1 else symbols[0]
+    if period is not None:
+        data = yf.download(tickers, period=period)['Adj Close']
+    else:
+        data = yf.download(tickers, start=start_date, end=end_date)['Adj Close']
 
     # Ensure the stock symbol is used as the column name
-    if len(stock_symbols) == 1:
-        stock_data = stock_data[['Adj Close']].rename(columns={'Adj Close': stock_symbols[0]})
-    else:
-        stock_data = stock_data['Adj Close']
-    return stock_data
+    if isinstance(data, pd.Series):
+        data = data.to_frame(name=symbols[0])
+    data = data.rename_axis('Date')
+
+    # A failed download comes back empty or with an empty column, it is not kept so the next call tries again
+    if data.empty or data.isna().all().any():
+        return data
+
+    _price_cache[key] = (time.time(), data)
+    if feather is not None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        feather.write_feather(data.reset_index(), path)
+    return data
+
+# Function that downloads the stock data
+def load_stock_data(transactions, start_date, end_date):
+    stock_symbols = list(dict.fromkeys(transaction[0] for transaction in transactions))
+    # The cached frame is shared between calls so we work on a copy
+    return _download_prices(tuple(sorted(stock_symbols)), start_date, end_date).copy()
 
 # Function that loads S&P 500 data
 def load_market_data(start_date, end_date):
     market_symbol = "^GSPC"  # S&P 500 index symbol
-    market_data = yf.download(market_symbol, start=start_date, end=end_date)['Adj Close']
+    market_data = _download_prices((market_symbol,), start_date, end_date)[market_symbol].copy()
     return market_data
 
 # Function that loads the 1 day closing price
 def get_current_prices(stock_symbols):
     if isinstance(stock_symbols, pd.Index):
         stock_symbols = stock_symbols.to_list()
-    stock_data = yf.download(stock_symbols, period="1d")["Adj Close"]
-    if isinstance(stock_data, pd.Series):
-        stock_data = stock_data.to_frame()
+    stock_data = _download_prices(tuple(sorted(set(stock_symbols))), period="1d")
     return stock_data.iloc[-1]
 
-# Function that updates the data for a specific time frame
-def update_data(transactions, start_date='2022-01-01', end_date='2023-05-25'):
+# Time frame used for every strategy and for the key statistics
+START_DATE = '2022-01-01'
+END_DATE = '2023-05-25'
+# Precision of the daily returns matrix, single precision is plenty for returns of the order of 1e-3
+RETURNS_DTYPE = np.float32
+
+# Data shared by the key statistics and the three strategies, built once per portfolio
+@dataclass
+class PortfolioContext:
+    transactions: list
+    selected_stocks: list
+    daily_returns: pd.DataFrame
+    market_daily_returns: pd.Series
+    current_prices: pd.Series
+    invested_amounts: pd.Series
+    # Daily returns as a contiguous RETURNS_DTYPE array, in the same order as selected_stocks
+    daily_returns_arr: np.ndarray = field(init=False)
+    # Centered market returns and their sum of squares, the same for every strategy
+    market_centered: np.ndarray = field(init=False)
+    market_ss: float = field(init=False)
+
+    def __post_init__(self):
+        self.daily_returns_arr = np.ascontiguousarray(self.daily_returns.to_numpy(dtype=RETURNS_DTYPE))
+        market = self.market_daily_returns.to_numpy(dtype=np.float64)
+        self.market_centered = market - market.mean()
+        self.market_ss = self.market_centered @ self.market_centered
+
+# Function that computes the daily returns from the prices, skipping the first day and the days with missing prices
+def _daily_returns(prices):
+    values = prices.to_numpy(dtype=np.float64)
+    returns = values[1:] / values[:-1] - 1.0
+    valid = ~np.isnan(returns.reshape(len(returns), -1)).any(axis=1)
+    return returns[valid], prices.index[1:][valid]
+
+# Function that downloads the data once and computes the aligned daily returns
+def build_context(transactions, start_date=START_DATE, end_date=END_DATE):
+    # Keep the stocks in the order they were bought
+    selected_stocks = list(dict.fromkeys(transaction[0] for transaction in transactions))
     stock_data = load_stock_data(transactions, start_date, end_date)
 
-    if isinstance(stock_data, pd.Series):
-        stock_data = stock_data.to_frame()
-
-    daily_returns = stock_data.pct_change().dropna()
+    stock_returns, stock_days = _daily_returns(stock_data[selected_stocks])
+    market_returns, market_days = _daily_returns(load_market_data(start_date, end_date))
+    # Keep only the days available for both the stocks and the market
+    _, stock_rows, market_rows = np.intersect1d(stock_days, market_days, assume_unique=True, return_indices=True)
+    daily_returns = pd.DataFrame(stock_returns[stock_rows], index=stock_days[stock_rows], columns=selected_stocks)
+    market_daily_returns = pd.Series(market_returns[market_rows], index=market_days[market_rows])
 
-    market_daily_returns = load_market_data(start_date, end_date).pct_change().dropna()
+    current_prices = get_current_prices(selected_stocks).reindex(selected_stocks)
 
-    market_daily_returns = market_daily_returns.reindex(daily_returns.index).dropna()
-    daily_returns = daily_returns.loc[market_daily_returns.index]
-
-    return daily_returns, market_daily_returns
+    # Compute the invested amounts for each stock
+    transactions_df = pd.DataFrame(transactions, columns=['stock', 'price', 'shares', 'amount'])
+    invested_amounts = transactions_df.groupby('stock', sort=False)['amount'].sum().reindex(selected_stocks)
+
+    return PortfolioContext(transactions, selected_stocks, daily_returns, market_daily_returns,
+                            current_prices, invested_amounts)
+
+# Function that computes the return, risk, Sharpe ratio and beta in a single pass over the portfolio returns
+@njit(cache=True)
+def _stats(p, market_centered, market_ss):
+    n = p.size
+    # Without any day the statistics are not defined
+    if n == 0:
+        return np.nan, np.nan, np.nan, np.nan
+    # The squares are taken around the first return so a flat portfolio gives a risk of exactly 0
+    shift = np.float64(p[0])
+    s = 0.0
+    s2 = 0.0
+    c = 0.0
+    for i in range(n):
+        # Accumulate in double precision whatever the dtype of the returns
+        x = np.float64(p[i])
+        d = x - shift
+        s += d
+        s2 += d * d
+        c += x * market_centered[i]
+    mean = shift + s / n
+    std = np.sqrt(max(s2 / n - (s / n) * (s / n), 0.0))
+    # A flat portfolio has no risk, so its Sharpe ratio is not defined
+    sharpe_ratio = mean / std if std > 0.0 else np.nan
+    # The market returns are centered so the cross product does not need the portfolio mean
+    beta = c / market_ss if market_ss > 0.0 else np.nan
+    return mean, std, sharpe_ratio, beta
+
+# Function that computes the return, risk, Sharpe ratio and beta of a portfolio
+def compute_statistics(context, weights):
+    if weights.size == 1:
+        # A single stock portfolio has the returns of the stock itself
+        portfolio_daily_returns = context.daily_returns_arr[:, 0]
+    else:
+        portfolio_daily_returns = context.daily_returns_arr @ weights.astype(context.daily_returns_arr.dtype)
+    # The beta measures the entire portfolio's sensitivity to market changes
+    return _stats(portfolio_daily_returns, context.market_centered, context.market_ss)
 
 # Function that calculates the key statistics
-def calculate_portfolio_statistics(transactions):
-
-    # Select the same time frame as for the update_data function
-    start_date = '2022-01-01'
-    end_date = '2023-05-25'
-    stock_data = load_stock_data(transactions, start_date, end_date)
-
-    if isinstance(stock_data, pd.Series):
-        stock_data = stock_data.to_frame()
-
-    daily_returns = stock_data.pct_change().dropna()
-    unique_stocks = daily_returns.columns
-
-    # Compute the invested amounts for each stock
-    invested_amounts = {}
-    for stock, _, _, amount_invested in transactions:
-        if stock in invested_amounts:
-            invested_amounts[stock] += amount_invested
-        else:
-            invested_amounts[stock] = amount_invested
-    # Compute the total invested in the portfolio
-    total_invested = sum(invested_amounts.values())
+def calculate_portfolio_statistics(context):
     # Compute the portfolio weights
-    portfolio_weights = np.array([invested_amounts[stock] / total_invested for stock in unique_stocks])
-    #Compute the return, level of risk and Sharpe ratio of the portfolio based on daily data obtained from Yahoo Finance
-    portfolio_daily_returns = np.dot(daily_returns.values, portfolio_weights.reshape(-1, 1))
-    portfolio_return = np.mean(portfolio_daily_returns)
-    portfolio_risk = np.std(portfolio_daily_returns)
-    sharpe_ratio = portfolio_return / portfolio_risk
-
-    market_daily_returns = load_market_data(start_date, end_date).pct_change().dropna()
-    # Calculate the beta of tha portfolio, the measure of an entire portfolio's sensitivity to market changes
-    market_daily_returns = market_daily_returns.reindex(daily_returns.index).dropna()
-    portfolio_daily_returns = pd.Series(portfolio_daily_returns.flatten(), index=daily_returns.index).loc[market_daily_returns.index]
-    beta = np.cov(portfolio_daily_returns.squeeze(), market_daily_returns)[0][1] / np.var(market_daily_returns)
-
-    return portfolio_return, portfolio_risk, sharpe_ratio, beta
+    total_invested = context.invested_amounts.sum()
+    portfolio_weights = context.invested_amounts.to_numpy() / total_invested
+
+    return compute_statistics(context, portfolio_weights)
+
+# Function that computes the negative diversification ratio minimised by the MDP (vol does not depend on the weights)
+@njit(cache=True, fastmath=True)
+def _neg_div(weights, data, vol):
+    weights = weights.astype(data.dtype)
+    p = data @ weights
+    vol_p = p.std() if p.size > 0 else 0.0
+    # Without any risk the ratio is not defined, return a flat objective instead of dividing by zero
+    if vol_p == 0.0:
+        return 0.0
+    return float(-(weights @ vol) / vol_p)
+
+# Function that computes the gradient of _neg_div with respect to the weights
+@njit(cache=True, fastmath=True)
+def _neg_div_grad(weights, data, vol):
+    weights = weights.astype(data.dtype)
+    if data.shape[0] == 0:
+        return np.zeros(weights.size)
+    p = data @ weights
+    p_centered = p - p.mean()
+    vol_p = np.sqrt(p_centered @ p_centered / p.size)
+    # Flat gradient where the objective is flat, see _neg_div
+    if vol_p == 0.0:
+        return np.zeros(weights.size)
+    d_vol_p = data.T @ p_centered / (p.size * vol_p)
+    # SLSQP only accepts float64 gradients
+    return (-vol / vol_p + (weights @ vol) / vol_p ** 2 * d_vol_p).astype(np.float64)
 
 # Function that compute the Most-Diversified Portfolio
-def MDP(transactions):
-
-    # Function that computes the standard deviation
-    def weighted_std(weights, data):
-        vol = np.nanstd(data, ddof=1, axis=0)
-        numerator = np.dot(weights.T, vol)
-        p = np.dot(data, weights.T)
-        vol_p = p.std()
-        return -numerator / vol_p
-    
+def MDP(context):
+
     # Function that performs the optimization
-    def calculate_MDP_weights(returns: pd.DataFrame):
-        bounds = [(0, 1) for _ in range(len(returns.columns))]
+    def calculate_MDP_weights(data: np.ndarray):
+        # A single stock gets all the weight, there is nothing to optimize
+        if data.shape[1] == 1:
+            return np.ones(1)
+        # With fewer than 2 days there is no covariance to work with, keep the equal weights
+        if data.shape[0] < 2:
+            return np.full(data.shape[1], 1.0 / data.shape[1])
+
+        # _daily_returns already removed the missing days, so no NaN-aware reduction is needed
+        vol = data.std(axis=0, ddof=1)
+        # Without any volatility there is no diversification to maximise, keep the equal weights
+        if not np.any(vol > 0):
+            return np.full(data.shape[1], 1.0 / data.shape[1])
+
+        # Start from the equal weights if the closed form cannot be computed
+        x0 = np.full(data.shape[1], 1.0 / data.shape[1])
+        # Without the no short selling constraint the weights are proportional to inv(Sigma) * vol
+        try:
+            closed_form = np.linalg.solve(np.atleast_2d(np.cov(data, rowvar=False)), vol)
+            closed_form /= closed_form.sum()
+            if np.all(np.isfinite(closed_form)):
+                if np.all(closed_form >= 0):
+                    return closed_form
+                # Otherwise use the clipped solution as the starting point of the optimization
+                x0 = closed_form.clip(0) / closed_form.clip(0).sum()
+        except np.linalg.LinAlgError:
+            pass
+
+        bounds = [(0, 1) for _ in range(data.shape[1])]
         cons = ({"type": "eq", "fun": lambda x: sum(x) - 1})
-        x0 = np.zeros(len(returns.columns)) + 0.01
-        sol = minimize(weighted_std, x0, method="SLSQP", args=returns,
-                       constraints=cons, bounds=bounds)
+        sol = minimize(_neg_div, x0, method="SLSQP", jac=_neg_div_grad, args=(data, vol),
+                       constraints=cons, bounds=bounds, options={"ftol": 1e-4, "maxiter": 50})
         return sol.x
     
     # Compute the new weights and the investments 
-    daily_returns, _ = update_data(transactions)
-    selected_stocks = list({transaction[0] for transaction in transactions})
-    selected_returns = daily_returns[selected_stocks]
-    mdp_weights = calculate_MDP_weights(selected_returns)
-    current_prices = get_current_prices(selected_returns.columns)
-    investments = calculate_investments(transactions, mdp_weights, current_prices)
+    mdp_weights = calculate_MDP_weights(context.daily_returns_arr)
+    investments = calculate_investments(context.transactions, mdp_weights, context.current_prices)
 
     # Compute the new key statistics for the same time frame
-    start_date = '2022-01-01'
-    end_date = '2023-05-25'
-    portfolio_weights = mdp_weights.reshape(-1, 1)
-    portfolio_daily_returns = np.dot(daily_returns.values, portfolio_weights)
-    # Compute the return, level of risk and Sharpe ratio of the portfolio based on daily data obtained from Yahoo Finance
-    portfolio_return = np.mean(portfolio_daily_returns)
-    portfolio_risk = np.std(portfolio_daily_returns)
-    sharpe_ratio = portfolio_return / portfolio_risk
-    # Calculate the beta of tha portfolio, the measure of an entire portfolio's sensitivity to market changes
-    market_daily_returns = load_market_data(start_date, end_date).pct_change().dropna()
-    market_daily_returns = market_daily_returns.reindex(daily_returns.index).dropna()
-    portfolio_daily_returns = pd.Series(portfolio_daily_returns.flatten(), index=daily_returns.index).loc[market_daily_returns.index]
-    beta = np.cov(portfolio_daily_returns.squeeze(), market_daily_returns)[0][1] / np.var(market_daily_returns)
-    
-    return mdp_weights, investments, portfolio_return, portfolio_risk, sharpe_ratio, beta
+    return (mdp_weights, investments) + compute_statistics(context, mdp_weights)
 
 # Function that compute the Equally-Weighted Portfolio
-def EWP(transactions):
+def EWP(context):
 
     # Function that computes the weights
     def EWP_inner(returns: pd.DataFrame, selected_stocks):
-        weight = np.zeros(len(returns.columns))
-        for stock in selected_stocks:
-            weight[returns.columns.get_loc(stock)] = 1 / len(selected_stocks)
+        weight = returns.columns.isin(selected_stocks).astype(np.float64)
+        weight /= weight.sum()
         return weight
     
     # Compute the new weights and the investments 
-    daily_returns, _ = update_data(transactions)
-    selected_stocks = list({transaction[0] for transaction in transactions})
-    selected_returns = daily_returns[selected_stocks]
-    ewp_weights = EWP_inner(selected_returns, selected_stocks)
-    current_prices = get_current_prices(selected_returns.columns)
-    investments = calculate_investments(transactions, ewp_weights, current_prices)
+    ewp_weights = EWP_inner(context.daily_returns, context.selected_stocks)
+    investments = calculate_investments(context.transactions, ewp_weights, context.current_prices)
 
     # Compute the new key statistics for the same time frame
-    start_date = '2022-01-01'
-    end_date = '2023-05-25'
-    portfolio_weights = ewp_weights.reshape(-1, 1)
-    portfolio_daily_returns = np.dot(daily_returns.values, portfolio_weights)
-    portfolio_return = np.mean(portfolio_daily_returns)
-    portfolio_risk = np.std(portfolio_daily_returns)
-    sharpe_ratio = portfolio_return / portfolio_risk
-    
-    market_daily_returns = load_market_data(start_date, end_date).pct_change().dropna()
-    market_daily_returns = market_daily_returns.reindex(daily_returns.index).dropna()
-    portfolio_daily_returns = pd.Series(portfolio_daily_returns.flatten(), index=daily_returns.index).loc[market_daily_returns.index]
-    beta = np.cov(portfolio_daily_returns.squeeze(), market_daily_returns)[0][1] / np.var(market_daily_returns)
-    
-    return ewp_weights, investments, portfolio_return, portfolio_risk, sharpe_ratio, beta
+    return (ewp_weights, investments) + compute_statistics(context, ewp_weights)
 
 # Function that compute the Return-Weighted Portfolio
-def RWP(transactions):
+def RWP(context):
 
-    # Function that computes the weights (we use the double sum so the weights add up to 1)
-    def RWP(returns: pd.DataFrame, selected_stocks):
-        weight = returns[selected_stocks].sum() / returns[selected_stocks].sum().sum()
-        return weight
+    # Function that computes the weights (we divide by the total so the weights add up to 1)
+    def RWP_weights(returns_arr: np.ndarray):
+        total_returns = returns_arr.sum(axis=0, dtype=np.float64)
+        return total_returns / total_returns.sum()
 
     # Compute the new weights and the investments 
-    daily_returns, _ = update_data(transactions)
-    selected_stocks = list({transaction[0] for transaction in transactions})
-    selected_returns = daily_returns[selected_stocks]
-    rwp_weights = RWP(selected_returns, selected_stocks)
-    current_prices = get_current_prices(selected_returns.columns)
-    investments = calculate_investments(transactions, rwp_weights, current_prices)
+    rwp_weights = RWP_weights(context.daily_returns_arr)
+    investments = calculate_investments(context.transactions, rwp_weights, context.current_prices)
 
     # Compute the new key statistics for the same time frame
-    start_date = '2022-01-01'
-    end_date = '2023-05-25'
-    portfolio_weights = rwp_weights.values.reshape(-1, 1)
-    portfolio_daily_returns = np.dot(daily_returns.values, portfolio_weights)
-    portfolio_return = np.mean(portfolio_daily_returns)
-    portfolio_risk = np.std(portfolio_daily_returns)
-    sharpe_ratio = portfolio_return / portfolio_risk
-    
-    market_daily_returns = load_market_data(start_date, end_date).pct_change().dropna()
-    market_daily_returns = market_daily_returns.reindex(daily_returns.index).dropna()
-    portfolio_daily_returns = pd.Series(portfolio_daily_returns.flatten(), index=daily_returns.index).loc[market_daily_returns.index]
-    beta = np.cov(portfolio_daily_returns.squeeze(), market_daily_returns)[0][1] / np.var(market_daily_returns)
-
-    return rwp_weights, investments, portfolio_return, portfolio_risk, sharpe_ratio, beta
+    return (rwp_weights, investments) + compute_statistics(context, rwp_weights)
 
 # Function that calculates the total investment that needs to be made for each stock (used for each strategy)
 def calculate_investments(transactions, weights, current_prices):